@@ -1,31 +1,68 @@
 # bot.py – Enhanced with /check route feature for Koyeb (Dec 2025)
 import os
+import atexit
+import queue
+import asyncio
+import contextlib
 import logging
+import signal
 import sqlite3
 import random
-from datetime import datetime, timedelta
+import re
+import time
+from datetime import date, datetime, timedelta
 
 from zoneinfo import ZoneInfo
 from telegram import Update
+from telegram.constants import MessageLimit
 from telegram.ext import Application, CommandHandler, ContextTypes
 
-# -------- Tiny web server to keep Koyeb health checks happy --------
-from threading import Thread
+# -------- Tiny web server for Koyeb health checks and Telegram webhooks --------
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
 
 app_web = FastAPI()
+app_web.state.application = None  # Set by run_webhook(); stays None when polling
 
 @app_web.get("/")
 async def root():
     return {"status": "alive"}
 
-def run_web_server():
-    uvicorn.run(app_web, host="0.0.0.0", port=8000, log_level="error")
+@app_web.post("/{token}")
+async def telegram_webhook(token: str, request: Request):
+    # The bot token doubles as the secret webhook path
+    application = app_web.state.application
+    if application is None or token != TOKEN:
+        raise HTTPException(status_code=404)
+    await application.update_queue.put(Update.de_json(await request.json(), application.bot))
+    return {"ok": True}
+
+class HealthServer(uvicorn.Server):
+    # uvicorn would replace the bot's SIGINT/SIGTERM handlers and re-raise them on exit;
+    # leave signals to the bot and stop the server through should_exit instead
+    def capture_signals(self):
+        return contextlib.nullcontext()
+
+web_server = HealthServer(
+    uvicorn.Config(app_web, host="0.0.0.0", port=int(os.getenv("PORT", 8000)),
+                   log_level="error", loop="asyncio")
+)
+
+async def start_web_server(application: Application):
+    # Serve the health check on the bot's own event loop instead of a second loop in a thread
+    application.bot_data["web_task"] = asyncio.create_task(web_server.serve())
+
+async def stop_web_server(application: Application):
+    # post_shutdown also runs when initialize() failed and post_init never started the server
+    task = application.bot_data.get("web_task")
+    if task:
+        web_server.should_exit = True
+        await task
 
 # -------------------------------------------------------------
 TOKEN = os.getenv("BOT_TOKEN")
 GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")  # Required for /check
+WEBHOOK_URL = os.getenv("KOYEB_URL")  # Public base URL; falls back to polling when unset
 TIMEZONE = ZoneInfo("Asia/Hong_Kong")
 DB_PATH = "bot_data.db"
 
@@ -39,57 +76,194 @@ QUOTES = [
     "Don't watch the clock; do what it does. Keep going.",
     "Everything you've ever wanted is on the other side of fear.",
 ]
+QUOTE_COUNT = len(QUOTES)
 
-# Google Maps integration for route checking
+# Google Maps integration for route checking; one client for the process so its
+# requests.Session keeps the HTTPS connection to Google alive between /check calls
 try:
-    import google.maps
-    gmaps = google.maps.Client(key=GOOGLE_MAPS_API_KEY)
+    import googlemaps
+    gmaps = googlemaps.Client(key=GOOGLE_MAPS_API_KEY, timeout=5)
 except ImportError:
     gmaps = None
 except Exception:
     gmaps = None  # Fallback if key is invalid
 
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;"
+    "PRAGMA synchronous=NORMAL;"
+    "PRAGMA busy_timeout=5000;"
+    "PRAGMA cache_size=-20000;"
+    "PRAGMA temp_store=MEMORY;"
+    "PRAGMA foreign_keys=ON;"
+)
+
+def _connect(mode: str = "rwc"):
+    # WAL lets readers and the writer run concurrently; NORMAL sync skips most fsyncs
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode={mode}", uri=True, cached_statements=256,
+                           isolation_level=None, check_same_thread=False)
+    conn.executescript(SQLITE_PRAGMAS)
+    return conn
+
+# One writer plus a pool of read-only connections, opened once by init_db()
+WRITER = None
+WRITE_LOCK = asyncio.Lock()
+READERS = queue.Queue()
+
+def _migrate_thought_timestamps(c):
+    # Older databases stored ISO text timestamps; rewrite them as unix epoch seconds
+    columns = {row[1]: row[2] for row in c.execute("PRAGMA table_info(thoughts)")}
+    if columns.get("timestamp", "").upper() != "TEXT":
+        return
+    c.executescript("""
+        BEGIN;
+        ALTER TABLE thoughts RENAME TO thoughts_old;
+        CREATE TABLE thoughts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER, timestamp INTEGER, text TEXT);
+        INSERT INTO thoughts (id, chat_id, timestamp, text)
+            SELECT id, chat_id, CAST(strftime('%s', timestamp) AS INTEGER), text FROM thoughts_old;
+        DROP TABLE thoughts_old;
+        COMMIT;
+    """)
+    logger.info("Migrated thoughts.timestamp from ISO text to epoch seconds")
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    global WRITER
+    WRITER = _connect()
+    atexit.register(WRITER.close)
+    c = WRITER.cursor()
     c.execute("""CREATE TABLE IF NOT EXISTS thoughts (
                  id INTEGER PRIMARY KEY AUTOINCREMENT,
-                 chat_id INTEGER, timestamp TEXT, text TEXT)""")
+                 chat_id INTEGER, timestamp INTEGER, text TEXT)""")
+    _migrate_thought_timestamps(c)
+    # Ascending (chat_id, timestamp) plus the implicit rowid serves both the newest-first
+    # (timestamp, id) keyset pages, scanned backwards, and the /today range
+    c.execute("CREATE INDEX IF NOT EXISTS idx_thoughts_chat_time ON thoughts(chat_id, timestamp)")
     c.execute("""CREATE TABLE IF NOT EXISTS reminders (
                  id INTEGER PRIMARY KEY AUTOINCREMENT,
-                 chat_id INTEGER, time_str TEXT, message TEXT)""")
-    conn.commit()
-    conn.close()
-
-def save_thought(chat_id: int, text: str):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    ts = datetime.now(TIMEZONE).isoformat()
-    c.execute("INSERT INTO thoughts (chat_id, timestamp, text) VALUES (?, ?, ?)",
-              (chat_id, ts, text.strip()))
-    conn.commit()
-    conn.close()
-
-def get_thoughts(chat_id: int, today_only: bool = False):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    if today_only:
-        date = datetime.now(TIMEZONE).date().isoformat()
-        c.execute("SELECT timestamp, text FROM thoughts WHERE chat_id = ? AND DATE(timestamp) = ? ORDER BY timestamp", (chat_id, date))
-    else:
-        c.execute("SELECT timestamp, text FROM thoughts WHERE chat_id = ? ORDER BY timestamp DESC LIMIT 30", (chat_id,))
-    rows = [{"time": r[0], "text": r[1]} for r in c.fetchall()]
-    conn.close()
-    return rows
+                 chat_id INTEGER, time_str TEXT, message TEXT, active INTEGER DEFAULT 1)""")
+    if "active" not in {row[1] for row in c.execute("PRAGMA table_info(reminders)")}:
+        c.execute("ALTER TABLE reminders ADD COLUMN active INTEGER DEFAULT 1")
+
+    # Readers need the file (and WAL mode) to exist, so open them after the schema
+    for _ in range(os.cpu_count() or 1):
+        reader = _connect("ro")
+        atexit.register(reader.close)
+        READERS.put(reader)
+
+# Keep SQL text identical across calls so sqlite3's statement cache reuses the compiled statement
+INSERT_THOUGHT_SQL = "INSERT INTO thoughts (chat_id, timestamp, text) VALUES (?, ?, ?)"
+
+def _write(sql: str, params=(), many: bool = False):
+    # BEGIN IMMEDIATE takes the write lock up front instead of failing with SQLITE_BUSY mid-transaction
+    WRITER.execute("BEGIN IMMEDIATE")
+    try:
+        if many:
+            WRITER.executemany(sql, params)
+        else:
+            WRITER.execute(sql, params)
+        WRITER.execute("COMMIT")
+    except Exception:
+        WRITER.execute("ROLLBACK")
+        raise
+
+async def save_thought(chat_id: int, text: str, now: datetime | None = None):
+    ts = int((now or datetime.now(TIMEZONE)).timestamp())
+    async with WRITE_LOCK:
+        _write(INSERT_THOUGHT_SQL, (chat_id, ts, text.strip()))
+
+async def save_thoughts_bulk(rows):
+    """Insert (chat_id, epoch_seconds, text) rows in a single transaction."""
+    async with WRITE_LOCK:
+        _write(INSERT_THOUGHT_SQL, rows, many=True)
+
+def load_reminders(job_queue):
+    # Re-create the daily jobs for stored reminders so they survive restarts and redeploys
+    rows = WRITER.execute("SELECT chat_id, time_str, message FROM reminders WHERE active = 1").fetchall()
+    for chat_id, time_str, message in rows:
+        schedule_reminder(job_queue, chat_id, datetime.strptime(time_str, "%H:%M").time(), message)
+    logger.info(f"Restored {len(rows)} reminders")
+
+THOUGHTS_PAGE_SIZE = 30
+
+def get_thoughts(chat_id: int, day: date | None = None, before: tuple[int, int] | None = None):
+    conn = READERS.get()
+    try:
+        c = conn.cursor()
+        if day:
+            # Half-open [midnight, next midnight) range so the (chat_id, timestamp) index is used
+            midnight = datetime.combine(day, datetime.min.time(), tzinfo=TIMEZONE)
+            start = int(midnight.timestamp())
+            end = int((midnight + timedelta(days=1)).timestamp())
+            c.execute("SELECT timestamp, text, id FROM thoughts WHERE chat_id = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp", (chat_id, start, end))
+        elif before:
+            # Keyset pagination: continue strictly after the last (timestamp, id) already shown
+            c.execute("SELECT timestamp, text, id FROM thoughts WHERE chat_id = ? AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT ?", (chat_id, *before, THOUGHTS_PAGE_SIZE))
+        else:
+            c.execute("SELECT timestamp, text, id FROM thoughts WHERE chat_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?", (chat_id, THOUGHTS_PAGE_SIZE))
+        return [{"time": r[0], "text": r[1], "id": r[2]} for r in c.fetchall()]
+    finally:
+        READERS.put(conn)
+
+MAX_MESSAGE_LEN = MessageLimit.MAX_TEXT_LENGTH - 96  # Headroom below Telegram's per-message cap
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LEN):
+    # Break on newlines where possible; only cut inside a line that is itself too long
+    chunks, current = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def reply_long(update: Update, text: str):
+    for chunk in split_message(text):
+        await update.message.reply_text(chunk)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Your personal reminder + journal bot is active.\n\n"
         "Commands:\n"
-        "/remind 08:30 Your message\n"
+        "/remind 08:30 Your message (daily) • /stopreminders\n"
         "/thought Your thought here\n"
-        "/today • /allthoughts • /motivate\n"
-        "/check → Fastest driving route home from company"
+        "/today • /allthoughts • /more • /motivate\n"
+        "/check → Fastest driving route home from company (add --fresh to skip the 1-min cache)"
+    )
+
+# Google's html_instructions contain <b>, <div>, <wbr> and other markup
+_TAG_RE = re.compile(r"<[^>]+>")
+
+def _strip_tags(html: str) -> str:
+    # Tags become spaces so "<div>Toll road</div>" doesn't run into the previous word
+    return " ".join(_TAG_RE.sub(" ", html).split())
+
+# (origin, destination, minute bucket) -> directions; only non-empty results are kept.
+# Only touched from the event loop, never from the to_thread workers.
+_route_cache = {}
+
+def _cache_route(key, directions):
+    # Entries from earlier minutes can never be hit again
+    for stale in [k for k in _route_cache if k[2] != key[2]]:
+        del _route_cache[stale]
+    _route_cache[key] = directions
+
+def _directions(origin: str, destination: str):
+    return gmaps.directions(
+        origin=origin,
+        destination=destination,
+        mode="driving",
+        traffic_model="best_guess",  # Accounts for typical traffic
+        departure_time="now"
     )
 
 async def check_route(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -103,14 +277,17 @@ async def check_route(update: Update, context: ContextTypes.DEFAULT_TYPE):
     origin = "博愛醫院歷屆總理聯誼會梁省德中學, Tsuen Wan, Hong Kong"
     destination = "利東邨東業樓, Ap Lei Chau, Hong Kong"
 
+    key = (origin, destination, int(time.time() // 60))
+    # "/check --fresh" skips the cached route and replaces it with the new one
+    fresh = "--fresh" in context.args
+
     try:
-        directions = gmaps.directions(
-            origin=origin,
-            destination=destination,
-            mode="driving",
-            traffic_model="best_guess",  # Accounts for typical traffic
-            departure_time="now"
-        )
+        directions = None if fresh else _route_cache.get(key)
+        if not directions:
+            # The googlemaps client is blocking; keep the event loop free for other commands
+            directions = await asyncio.to_thread(_directions, origin, destination)
+            if directions:
+                _cache_route(key, directions)
         if not directions:
             await update.message.reply_text("Unable to retrieve route. Please try again.")
             return
@@ -121,11 +298,11 @@ async def check_route(update: Update, context: ContextTypes.DEFAULT_TYPE):
         steps = route['legs'][0]['steps']
 
         # Summarize key steps (first 7 for brevity)
-        step_summary = "Route Steps:\n"
-        for i, step in enumerate(steps[:7], 1):
-            step_summary += f"{i}. {step['html_instructions'].replace('<b>', '').replace('</b>', '').strip()}\n"
+        lines = ["Route Steps:"]
+        lines += [f"{i}. {_strip_tags(step['html_instructions'])}" for i, step in enumerate(steps[:7], 1)]
         if len(steps) > 7:
-            step_summary += f"... (Total: {len(steps)} steps)"
+            lines.append(f"... (Total: {len(steps)} steps)")
+        step_summary = "\n".join(lines)
 
         response = (
             f"Fastest Driving Route (Company → Home)\n"
@@ -139,6 +316,18 @@ async def check_route(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Route API error: {e}")
         await update.message.reply_text("Route calculation failed. Check logs or try again.")
 
+async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
+    await context.bot.send_message(chat_id=context.job.chat_id, text=f"Reminder: {context.job.data}")
+
+def schedule_reminder(job_queue, chat_id: int, remind_at, message: str):
+    job_queue.run_daily(
+        send_reminder,
+        time=remind_at.replace(tzinfo=TIMEZONE),
+        chat_id=chat_id,
+        data=message,
+        name=f"remind_{chat_id}"
+    )
+
 async def remind_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) < 2:
         await update.message.reply_text("Usage: /remind 08:30 Your message")
@@ -146,75 +335,126 @@ async def remind_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     time_str = context.args[0]
     message = " ".join(context.args[1:])
     try:
-        datetime.strptime(time_str, "%H:%M")
+        remind_at = datetime.strptime(time_str, "%H:%M").time()
     except ValueError:
         await update.message.reply_text("Time must be HH:MM (24h)")
         return
 
     now = datetime.now(TIMEZONE)
-    target = datetime.strptime(f"{now.date()} {time_str}", "%Y-%m-%d %H:%M").replace(tzinfo=TIMEZONE)
+    target = datetime.combine(now.date(), remind_at, tzinfo=TIMEZONE)
     if target < now:
         target += timedelta(days=1)
-    delay = (target - now).total_seconds()
 
-    context.job_queue.run_once(
-        callback=lambda ctx: ctx.bot.send_message(chat_id=update.effective_chat.id, text=f"Reminder: {message}"),
-        when=delay,
-        name=f"remind_{update.effective_chat.id}"
-    )
-    await update.message.reply_text(f"Reminder set for {time_str} tomorrow.\n\"{message}\"")
+    chat_id = update.effective_chat.id
+    async with WRITE_LOCK:
+        _write("INSERT INTO reminders (chat_id, time_str, message) VALUES (?, ?, ?)",
+               (chat_id, remind_at.strftime("%H:%M"), message))
+    schedule_reminder(context.job_queue, chat_id, remind_at, message)
+    day = "today" if target.date() == now.date() else "tomorrow"
+    await update.message.reply_text(f"Daily reminder set for {time_str}, starting {day}.\n\"{message}\"")
+
+async def stop_reminders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    async with WRITE_LOCK:
+        _write("UPDATE reminders SET active = 0 WHERE chat_id = ? AND active = 1", (chat_id,))
+    jobs = context.job_queue.get_jobs_by_name(f"remind_{chat_id}")
+    for job in jobs:
+        job.schedule_removal()
+    await update.message.reply_text(f"Stopped {len(jobs)} reminder(s).")
 
 async def thought_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text("Usage: /thought Your thought here")
         return
     text = " ".join(context.args)
-    save_thought(update.effective_chat.id, text)
-    await update.message.reply_text(f"Saved at {datetime.now(TIMEZONE).strftime('%H:%M')}\n\n“{text}”")
+    now = datetime.now(TIMEZONE)
+    await save_thought(update.effective_chat.id, text, now)
+    await update.message.reply_text(f"Saved at {now.strftime('%H:%M')}\n\n“{text}”")
 
 async def today_thoughts(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    thoughts = get_thoughts(update.effective_chat.id, today_only=True)
+    today = datetime.now(TIMEZONE).date()
+    thoughts = get_thoughts(update.effective_chat.id, today)
     if not thoughts:
         await update.message.reply_text("No thoughts today yet.")
         return
-    msg = f"Today's thoughts ({datetime.now(TIMEZONE).date()}):\n\n"
-    for t in thoughts:
-        msg += f"• {datetime.fromisoformat(t['time']).strftime('%H:%M')} — {t['text']}\n"
-    await update.message.reply_text(msg)
+    lines = [f"• {datetime.fromtimestamp(t['time'], TIMEZONE).strftime('%H:%M')} — {t['text']}" for t in thoughts]
+    header = f"Today's thoughts ({today.isoformat()}):\n\n"
+    await reply_long(update, header + "\n".join(lines))
 
 async def all_thoughts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     thoughts = get_thoughts(update.effective_chat.id)
     if not thoughts:
         await update.message.reply_text("No thoughts saved yet.")
         return
-    msg = f"Last {len(thoughts)} thoughts:\n\n"
-    for t in thoughts:
-        msg += f"{datetime.fromisoformat(t['time']).strftime('%Y-%m-%d %H:%M')} → {t['text']}\n"
-    await update.message.reply_text(msg)
+    await send_thoughts_page(update, context, thoughts, f"Last {len(thoughts)} thoughts:\n\n")
+
+async def more_thoughts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    before = context.chat_data.get("thoughts_before")
+    if not before:
+        await update.message.reply_text("Use /allthoughts first.")
+        return
+    thoughts = get_thoughts(update.effective_chat.id, before=before)
+    if not thoughts:
+        await update.message.reply_text("No older thoughts.")
+        return
+    await send_thoughts_page(update, context, thoughts, f"{len(thoughts)} older thoughts:\n\n")
+
+async def send_thoughts_page(update: Update, context: ContextTypes.DEFAULT_TYPE, thoughts, header: str):
+    # Remember where this page ended so /more can continue from there
+    context.chat_data["thoughts_before"] = (thoughts[-1]["time"], thoughts[-1]["id"])
+    lines = [f"{datetime.fromtimestamp(t['time'], TIMEZONE).strftime('%Y-%m-%d %H:%M')} → {t['text']}" for t in thoughts]
+    if len(thoughts) == THOUGHTS_PAGE_SIZE:
+        lines.append("\n/more → older thoughts")
+    await reply_long(update, header + "\n".join(lines))
 
 async def motivate(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(f"“{random.choice(QUOTES)}”")
+    await update.message.reply_text(f"“{QUOTES[random.randrange(QUOTE_COUNT)]}”")
+
+async def run_webhook(application: Application):
+    # Telegram pushes updates to the FastAPI route, so nothing polls getUpdates
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, setattr, web_server, "should_exit", True)
+    app_web.state.application = application
+    async with application:
+        await application.bot.set_webhook(f"{WEBHOOK_URL}/{TOKEN}", allowed_updates=[Update.MESSAGE])
+        await application.start()
+        try:
+            await web_server.serve()
+        finally:
+            await application.stop()
 
 def main():
     init_db()
     if not TOKEN:
         raise ValueError("BOT_TOKEN not set!")
 
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(start_web_server)
+        .post_shutdown(stop_web_server)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("remind", remind_command))
+    application.add_handler(CommandHandler("stopreminders", stop_reminders))
     application.add_handler(CommandHandler("thought", thought_command))
     application.add_handler(CommandHandler("today", today_thoughts))
     application.add_handler(CommandHandler("allthoughts", all_thoughts))
+    application.add_handler(CommandHandler("more", more_thoughts))
     application.add_handler(CommandHandler("motivate", motivate))
     application.add_handler(CommandHandler("check", check_route))  # New command
 
-    # Start web server in background
-    Thread(target=run_web_server, daemon=True).start()
+    load_reminders(application.job_queue)
 
     print("Bot running 24/7 on Koyeb with route check!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        # Only commands are handled, so skip every other update type; long-poll instead of re-polling
+        application.run_polling(allowed_updates=[Update.MESSAGE], timeout=30, poll_interval=0.0)
 
 if __name__ == "__main__":
     main()